@@ -1,25 +1,85 @@
+import asyncio
 import datetime
+import json
+import random
 import time
+from zoneinfo import ZoneInfo
 
 import openai
-import pytz
+import openai.api_requestor
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def _build_http_session():
+    """Return a pooled requests session so sync OpenAI calls reuse TLS connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=0)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared across all APIUtil instances (retries are handled by _retry_call).
+# Only the sync SDK calls use it; ChatCompletion.acreate goes through aiohttp.
+_HTTP_SESSION = _build_http_session()
+
+_RIGA_TZ = ZoneInfo("Europe/Riga")
+
+
+class _OrjsonCodec:
+    """Drop-in for the stdlib json module as used by openai.api_requestor"""
+
+    loads = staticmethod(orjson.loads)
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        if kwargs:
+            return json.dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            return json.dumps(obj)
+
+
+# openai<1.0 encodes requests and decodes responses with stdlib json
+openai.api_requestor.json = _OrjsonCodec
+openai.requestssession = _HTTP_SESSION
+
+_RETRY_EXCEPTIONS = (
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.RateLimitError,
+)
+
+
+def _backoff_delay(backoff, max_delay, jitter):
+    """Cap the backoff and add random jitter so concurrent retries don't collide"""
+    return min(max_delay, backoff) * (1 + random.random() * jitter)
 
 
 def get_current_time():
     """Return current time in Europe/Riga timezone"""
-    return datetime.datetime.now(pytz.timezone("Europe/Riga"))
+    return datetime.datetime.now(_RIGA_TZ)
+
+
+_ESCAPE_TABLE = str.maketrans(
+    {
+        "\\": "\\\\",
+        '"': '\\"',
+        "'": "\\'",
+        "\n": "\\n",
+        "\t": "\\t",
+        "\r": "\\r",
+    }
+)
 
 
 def escape_special_chars(text: str) -> str:
     """Escape special characters in text"""
-    return (
-        text.replace("\\", "\\\\")
-        .replace('"', '\\"')
-        .replace("'", "\\'")
-        .replace("\n", "\\n")
-        .replace("\t", "\\t")
-        .replace("\r", "\\r")
-    )
+    return text.translate(_ESCAPE_TABLE)
 
 
 class APIUtil:
@@ -33,26 +93,39 @@ class APIUtil:
 
     def __init__(self, api_key, restart_sequence="|UR|", stop_sequence="|SP|"):
         self.api_key = api_key
-        openai.api_key = api_key
         self.stop_sequence = stop_sequence
         self.restart_sequence = restart_sequence
 
     # ---------------- Retry Wrapper ----------------
-    def _retry_call(self, func, *args, max_tries=3, initial_backoff=1, **kwargs):
+    def _retry_call(
+        self, func, *args, max_tries=3, initial_backoff=1, max_delay=30, jitter=0.5, **kwargs
+    ):
         """Generic retry wrapper for OpenAI API calls"""
-        RETRY_EXCEPTIONS = (
-            openai.error.APIError,
-            openai.error.Timeout,
-            openai.error.APIConnectionError,
-            openai.error.ServiceUnavailableError,
-        )
         tries, backoff = 0, initial_backoff
         while True:
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                if isinstance(e, RETRY_EXCEPTIONS) and tries < max_tries:
-                    time.sleep(backoff)
+                if isinstance(e, _RETRY_EXCEPTIONS) and tries < max_tries:
+                    time.sleep(_backoff_delay(backoff, max_delay, jitter))
+                    backoff *= 2
+                    tries += 1
+                else:
+                    raise self.OpenAIError(
+                        f"OpenAI API Error: {str(e)}", error_type=type(e).__name__
+                    ) from e
+
+    async def _aretry_call(
+        self, func, *args, max_tries=3, initial_backoff=1, max_delay=30, jitter=0.5, **kwargs
+    ):
+        """Async counterpart of _retry_call for awaitable OpenAI API calls"""
+        tries, backoff = 0, initial_backoff
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if isinstance(e, _RETRY_EXCEPTIONS) and tries < max_tries:
+                    await asyncio.sleep(_backoff_delay(backoff, max_delay, jitter))
                     backoff *= 2
                     tries += 1
                 else:
@@ -63,20 +136,29 @@ class APIUtil:
     # ---------------- Moderation ----------------
     def get_moderation(self, user_message: str):
         """Check moderation flags for a user message"""
+        return self.get_moderation_batch([user_message])[0]
+
+    def get_moderation_batch(self, user_messages: list[str]) -> list[dict]:
+        """Check moderation flags for several messages in a single request"""
+        if not user_messages:
+            return []
         try:
             moderation = self._retry_call(
-                openai.Moderation.create, input=escape_special_chars(user_message)
+                openai.Moderation.create,
+                input=list(user_messages),
+                api_key=self.api_key,
             )
-            moderation_result = moderation["results"][0]
-            flagged_categories = [
-                category
-                for category, value in moderation_result["categories"].items()
-                if value
+            return [
+                {
+                    "flagged": moderation_result["flagged"],
+                    "flagged_categories": [
+                        category
+                        for category, value in moderation_result["categories"].items()
+                        if value
+                    ],
+                }
+                for moderation_result in moderation["results"]
             ]
-            return {
-                "flagged": moderation_result["flagged"],
-                "flagged_categories": flagged_categories,
-            }
         except Exception as e:
             raise self.OpenAIError(str(e)) from e
 
@@ -84,63 +166,125 @@ class APIUtil:
     def get_models(self):
         """Return models available to the API key"""
         try:
-            return self._retry_call(openai.Model.list)
+            return self._retry_call(openai.Model.list, api_key=self.api_key)
         except Exception as e:
             raise self.OpenAIError(str(e)) from e
 
     # ---------------- Main: AI Response ----------------
-    def get_ai_response(self, model_config_dict, prompt, messages):
+    def get_ai_response(self, model_config_dict, prompt, messages, oai_messages=None, on_delta=None):
         """
         Generate AI response for given model config.
         For gpt-5 models → only send minimal params.
+        messages is not modified; the result's "message" is the new assistant turn
+        for the caller to append.
+        Pass oai_messages (messages already in OpenAI format) to skip reconverting
+        the whole history; the result's "oai_message" is the new turn to append to it.
+        If on_delta is given the response is streamed and on_delta is called with
+        each content fragment as it arrives (except gpt-5 models, see _can_stream).
         """
-        self._validate_model_config(model_config_dict)
+        params = self._build_chat_params(model_config_dict, prompt, messages, oai_messages)
+        try:
+            if on_delta is None or not self._can_stream(model_config_dict):
+                response = self._retry_call(openai.ChatCompletion.create, **params)
+                return self._parse_chat_response(response)
 
-        submit_messages = [{"role": "system", "content": prompt}] + self._messages_to_oai_messages(messages)
+            chunks, usage = [], {}
+            stream = self._retry_call(openai.ChatCompletion.create, **self._stream_params(params))
+            for chunk in stream:
+                usage = self._consume_stream_chunk(chunk, chunks, on_delta) or usage
+            return self._build_ai_response("".join(chunks), usage)
+        except Exception as e:
+            raise self.OpenAIError(str(e)) from e
 
+    async def aget_ai_response(
+        self, model_config_dict, prompt, messages, oai_messages=None, on_delta=None
+    ):
+        """Async version of get_ai_response, so several models can run concurrently"""
+        params = self._build_chat_params(model_config_dict, prompt, messages, oai_messages)
         try:
-            if model_config_dict["model"].startswith("gpt-5"):
-                # ✅ Ultra simple call (no stop, no temperature, etc.)
-                params = {
-                    "model": model_config_dict["model"],
-                    "messages": submit_messages,
-                    "max_completion_tokens": model_config_dict["max_tokens"],
-                }
-            else:
-                # ✅ Normal GPT-3.5 / GPT-4 / GPT-4o call with tuning params
-                params = {
-                    "model": model_config_dict["model"],
-                    "messages": submit_messages,
-                    "temperature": model_config_dict["temperature"],
-                    "max_tokens": model_config_dict["max_tokens"],
-                    "top_p": model_config_dict["top_p"],
-                    "frequency_penalty": model_config_dict["frequency_penalty"],
-                    "presence_penalty": model_config_dict["presence_penalty"],
-                    "stop": [self.stop_sequence],
-                }
+            if on_delta is None or not self._can_stream(model_config_dict):
+                response = await self._aretry_call(openai.ChatCompletion.acreate, **params)
+                return self._parse_chat_response(response)
 
-            response = self._retry_call(openai.ChatCompletion.create, **params)
+            chunks, usage = [], {}
+            stream = await self._aretry_call(
+                openai.ChatCompletion.acreate, **self._stream_params(params)
+            )
+            async for chunk in stream:
+                usage = self._consume_stream_chunk(chunk, chunks, on_delta) or usage
+            return self._build_ai_response("".join(chunks), usage)
+        except Exception as e:
+            raise self.OpenAIError(str(e)) from e
 
-            bot_message = response["choices"][0]["message"]["content"].strip()
-            usage = response.get("usage", {})
-            total_tokens = usage.get("total_tokens", 0)
-            prompt_tokens = usage.get("prompt_tokens", 0)
-            completion_tokens = usage.get("completion_tokens", 0)
+    # ---------------- Helpers ----------------
+    def _build_chat_params(self, model_config_dict, prompt, messages, oai_messages=None):
+        """Build ChatCompletion request params for the given model config"""
+        self._validate_model_config(model_config_dict)
 
-            new_messages = messages + [
-                {"role": "assistant", "message": bot_message, "created_date": get_current_time()}
-            ]
+        if oai_messages is None:
+            oai_messages = self._messages_to_oai_messages(messages)
+        submit_messages = [{"role": "system", "content": prompt}] + oai_messages
 
+        if model_config_dict["model"].startswith("gpt-5"):
+            # ✅ Ultra simple call (no stop, no temperature, etc.)
             return {
-                "messages": new_messages,
-                "total_tokens": total_tokens,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
+                "api_key": self.api_key,
+                "model": model_config_dict["model"],
+                "messages": submit_messages,
+                "max_completion_tokens": model_config_dict["max_tokens"],
             }
-        except Exception as e:
-            raise self.OpenAIError(str(e)) from e
+        # ✅ Normal GPT-3.5 / GPT-4 / GPT-4o call with tuning params
+        return {
+            "api_key": self.api_key,
+            "model": model_config_dict["model"],
+            "messages": submit_messages,
+            "temperature": model_config_dict["temperature"],
+            "max_tokens": model_config_dict["max_tokens"],
+            "top_p": model_config_dict["top_p"],
+            "frequency_penalty": model_config_dict["frequency_penalty"],
+            "presence_penalty": model_config_dict["presence_penalty"],
+            "stop": [self.stop_sequence],
+        }
+
+    def _can_stream(self, model_config_dict):
+        """gpt-5 models reject streaming unless the organization is verified"""
+        return not model_config_dict["model"].startswith("gpt-5")
+
+    def _stream_params(self, params):
+        """Streamed variant of params; include_usage adds a final chunk carrying token usage"""
+        return {**params, "stream": True, "stream_options": {"include_usage": True}}
+
+    def _consume_stream_chunk(self, chunk, chunks, on_delta):
+        """Collect and forward a chunk's content delta; return its usage if it carries one"""
+        if chunk["choices"]:
+            delta = chunk["choices"][0]["delta"].get("content") or ""
+            if delta:
+                chunks.append(delta)
+                on_delta(delta)
+        return chunk.get("usage")
+
+    def _parse_chat_response(self, response):
+        """Extract the assistant message and token usage from a ChatCompletion response"""
+        return self._build_ai_response(
+            response["choices"][0]["message"]["content"], response.get("usage", {})
+        )
+
+    def _build_ai_response(self, content, usage):
+        bot_message = content.strip()
+        total_tokens = usage.get("total_tokens", 0)
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+
+        new_message = {"role": "assistant", "message": bot_message, "created_date": get_current_time()}
+
+        return {
+            "message": new_message,
+            "oai_message": self._message_to_oai_message(new_message),
+            "total_tokens": total_tokens,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        }
 
-    # ---------------- Helpers ----------------
     def _validate_model_config(self, model_config_dict):
         required_fields = [
             "model",
@@ -159,9 +303,8 @@ class APIUtil:
 
     def _messages_to_oai_messages(self, messages):
         """Convert internal messages format into OpenAI-compatible messages"""
-        oai_messages = []
-        for message in messages:
-            oai_messages.append(
-                {"role": message["role"], "content": escape_special_chars(message["message"])}
-            )
-        return oai_messages
+        return [self._message_to_oai_message(message) for message in messages]
+
+    def _message_to_oai_message(self, message):
+        """Convert a single internal message into an OpenAI-compatible message"""
+        return {"role": message["role"], "content": message["message"]}
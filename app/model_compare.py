@@ -1,10 +1,10 @@
+import asyncio
 import logging
 
 import api_util as api
+import numpy as np
 import streamlit as st
 
-st.set_page_config(layout="wide")
-
 # ✅ Only allow 5 models
 ALLOWED_MODELS = [
     ("gpt-4", 8000),
@@ -14,36 +14,106 @@ ALLOWED_MODELS = [
     ("gpt-3.5-turbo-16k", 16000),
 ]
 
+# USD per 1K tokens: (prompt, completion)
+MODEL_PRICING = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-5-nano-2025-08-07": (0.02, 0.02),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+DEFAULT_PRICING = (0.001, 0.001)
+
+# Per-model counters live in one array: row = MODEL_IDX[model], columns below
+MODEL_IDX = {m: i for i, (m, _) in enumerate(ALLOWED_MODELS)}
+TOTAL_TOKENS, PROMPT_TOKENS, COMPLETION_TOKENS, COST_MICRO_USD = range(4)
+
+def new_counters():
+    return np.zeros((len(ALLOWED_MODELS), 4), dtype=np.int64)
+
+@st.cache_resource(max_entries=32, ttl=3600)
+def get_api_util(api_key):
+    """Return the APIUtil for this key, reused across Streamlit reruns"""
+    return api.APIUtil(api_key=api_key)
+
+def reset_test_state():
+    """Clear per-model histories and counters in a single pass over the models"""
+    chat_histories, oai_histories = {}, {}
+    for m in st.session_state.openai_models:
+        chat_histories[m] = []
+        oai_histories[m] = []
+    st.session_state.chat_histories = chat_histories
+    st.session_state.oai_histories = oai_histories
+    st.session_state.counters = new_counters()
+
 def handler_verify_key():
     """Initialize allowed models"""
     oai_api_key = st.session_state.open_ai_key_input
-    _ = api.APIUtil(api_key=oai_api_key)
+    _ = get_api_util(oai_api_key)
     try:
         st.session_state.openai_model_params = ALLOWED_MODELS
         st.session_state.openai_models = [m for m, _ in ALLOWED_MODELS]
         st.session_state.openai_models_str = ", ".join(st.session_state.openai_models)
 
-        st.session_state.chat_histories = {m: [] for m in st.session_state.openai_models}
-        st.session_state.total_tokens = {m: 0 for m in st.session_state.openai_models}
-        st.session_state.prompt_tokens = {m: 0 for m in st.session_state.openai_models}
-        st.session_state.completion_tokens = {m: 0 for m in st.session_state.openai_models}
-        st.session_state.conversation_cost = {m: 0 for m in st.session_state.openai_models}
+        reset_test_state()
 
         st.session_state.oai_api_key = oai_api_key
         st.session_state.test_disabled = False
     except Exception as e:
         logging.error(f"{e}")
 
-def calculate_cost(model, tokens, prompt_tokens=0, completion_tokens=0):
-    if model == "gpt-4":
-        return (0.03 * prompt_tokens / 1000) + (0.06 * completion_tokens / 1000)
-    elif model == "gpt-3.5-turbo":
-        return 0.002 * tokens / 1000
-    elif model == "gpt-5-nano-2025-08-07":
-        return 0.02 * tokens / 1000
-    return 0.001 * tokens / 1000
+def calculate_cost(model, prompt_tokens=0, completion_tokens=0):
+    prompt_rate, completion_rate = MODEL_PRICING.get(model, DEFAULT_PRICING)
+    return (prompt_rate * prompt_tokens + completion_rate * completion_tokens) / 1000
+
+async def _fetch_model_response(o, model_config_dict, prompt, messages, oai_messages, placeholder):
+    """Run one model request, returning the exception instead of raising it"""
+    chunks = []
+
+    def on_delta(delta):
+        chunks.append(delta)
+        placeholder.markdown("".join(chunks))
+
+    try:
+        return model_config_dict["model"], await o.aget_ai_response(
+            model_config_dict=model_config_dict,
+            prompt=prompt,
+            messages=messages,
+            oai_messages=oai_messages,
+            on_delta=on_delta,
+        )
+    except Exception as e:
+        return model_config_dict["model"], e
+
+async def _fetch_all_model_responses(o, model_config_template, init_prompt):
+    """Fan out requests to all models concurrently, streaming each reply as it arrives"""
+    models = st.session_state.openai_models
+    with progress_bar_container.container():
+        progress_bar = st.progress(0.0, text=f"{len(models)} models running...")
+        placeholders = {m: col.empty() for m, col in zip(models, st.columns(len(models)))}
+    tasks = [
+        _fetch_model_response(
+            o,
+            {**model_config_template, "model": m},
+            init_prompt,
+            st.session_state.chat_histories[m],
+            st.session_state.oai_histories[m],
+            placeholders[m],
+        )
+        for m in models
+    ]
+    results = {}
+    for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+        m, b_r = await task
+        results[m] = b_r
+        progress_bar.progress(done / len(models), text=f"{m} finished")
+    return results
 
 def handler_fetch_model_responses():
+    init_prompt = st.session_state.init_prompt
+    if not init_prompt or not init_prompt.strip():
+        return
+
     model_config_template = {
         "max_tokens": st.session_state.model_max_tokens,
         "temperature": st.session_state.model_temperature,
@@ -51,35 +121,26 @@ def handler_fetch_model_responses():
         "frequency_penalty": st.session_state.model_frequency_penalty,
         "presence_penalty": st.session_state.model_presence_penalty,
     }
-    o = api.APIUtil(api_key=st.session_state.oai_api_key)
-    init_prompt = st.session_state.init_prompt
-    if not init_prompt:
-        return
+    o = get_api_util(st.session_state.oai_api_key)
 
-    for idx, m in enumerate(st.session_state.openai_models):
-        progress_bar_container.progress(idx / len(st.session_state.openai_models), text=f"{m} running...")
-        try:
-            b_r = o.get_ai_response(
-                model_config_dict={**model_config_template, "model": m},
-                prompt=init_prompt,
-                messages=st.session_state.chat_histories[m],
-            )
-            st.session_state.chat_histories[m] = b_r["messages"]
-            st.session_state.total_tokens[m] = b_r["total_tokens"]
-            st.session_state.prompt_tokens[m] = b_r["prompt_tokens"]
-            st.session_state.completion_tokens[m] = b_r["completion_tokens"]
-            st.session_state.conversation_cost[m] = calculate_cost(
-                m, b_r["total_tokens"], b_r["prompt_tokens"], b_r["completion_tokens"]
-            )
-        except Exception as e:
-            logging.error(f"Error with {m}: {e}")
+    results = asyncio.run(_fetch_all_model_responses(o, model_config_template, init_prompt))
+    for m, b_r in results.items():
+        if isinstance(b_r, Exception):
+            logging.error(f"Error with {m}: {b_r}")
             continue
+        st.session_state.chat_histories[m].append(b_r["message"])
+        st.session_state.oai_histories[m].append(b_r["oai_message"])
+        cost = calculate_cost(m, b_r["prompt_tokens"], b_r["completion_tokens"])
+        st.session_state.counters[MODEL_IDX[m]] = (
+            b_r["total_tokens"],
+            b_r["prompt_tokens"],
+            b_r["completion_tokens"],
+            round(cost * 1e6),
+        )
     progress_bar_container.empty()
 
 def handler_start_new_test():
-    st.session_state.chat_histories = {m: [] for m in st.session_state.openai_models}
-    st.session_state.total_tokens = {m: 0 for m in st.session_state.openai_models}
-    st.session_state.conversation_cost = {m: 0 for m in st.session_state.openai_models}
+    reset_test_state()
 
 def ui_sidebar():
     with st.sidebar:
@@ -111,10 +172,11 @@ def ui_test_result():
         for i, m in enumerate(st.session_state.openai_models):
             with cols[i]:
                 st.write(f"### Conversation with {m}")
-                st.write(f"Total tokens: {st.session_state.total_tokens[m]}")
-                st.write(f"Prompt tokens: {st.session_state.prompt_tokens[m]}")
-                st.write(f"Completion tokens: {st.session_state.completion_tokens[m]}")
-                st.write(f"Total cost: ${st.session_state.conversation_cost[m]:.6f}")
+                counters = st.session_state.counters[MODEL_IDX[m]]
+                st.write(f"Total tokens: {counters[TOTAL_TOKENS]}")
+                st.write(f"Prompt tokens: {counters[PROMPT_TOKENS]}")
+                st.write(f"Completion tokens: {counters[COMPLETION_TOKENS]}")
+                st.write(f"Total cost: ${counters[COST_MICRO_USD] / 1e6:.6f}")
                 st.write("---")
                 for msg in st.session_state.chat_histories[m]:
                     if msg["role"] == "user":
@@ -122,19 +184,27 @@ def ui_test_result():
                     else:
                         st.markdown(f"**Model:** {msg['message']}")
 
-if "test_disabled" not in st.session_state:
-    st.session_state.test_disabled = True
+def main():
+    global progress_bar_container
+
+    st.set_page_config(layout="wide")
+
+    if "test_disabled" not in st.session_state:
+        st.session_state.test_disabled = True
+
+    openai_key_container = st.container()
+    ui_sidebar()
 
-openai_key_container = st.container()
-ui_sidebar()
+    st.title("OpenAI GPT Model Comparison Tool")
 
-st.title("OpenAI GPT Model Comparison Tool")
+    if "oai_api_key" not in st.session_state:
+        st.write("👋 Paste your OpenAI API key to start.")
+        ui_introduction()
+    else:
+        st.write(f"Comparing: {st.session_state.openai_models_str}")
+        st.write("---")
+        progress_bar_container = st.empty()
+        ui_test_result()
 
-if "oai_api_key" not in st.session_state:
-    st.write("👋 Paste your OpenAI API key to start.")
-    ui_introduction()
-else:
-    st.write(f"Comparing: {st.session_state.openai_models_str}")
-    st.write("---")
-    progress_bar_container = st.empty()
-    ui_test_result()
+if __name__ == "__main__":
+    main()